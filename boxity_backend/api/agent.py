@@ -1,6 +1,6 @@
 import logging
 import os
-from typing import Dict, Any, List, Optional, Tuple, Type
+from typing import Dict, Any, List, Optional, Type
 from datetime import datetime
 from pydantic import BaseModel, Field
 
@@ -8,7 +8,7 @@ from langchain_core.tools import BaseTool
 from langchain_core.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 
-from .ai import call_gemini_ensemble
+from .ai import ImageInput, call_gemini_ensemble
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +32,7 @@ class PerceptionOutput(BaseModel):
     differences: List[Dict[str, Any]]
     overall_confidence: float
     max_severity: str
+    failed: bool = False
 
 class DecisionOutput(BaseModel):
     decision: str = Field(description="APPROVE, APPROVE WITH FLAG, QUARANTINE, or REANALYZE")
@@ -50,13 +51,20 @@ class PerceptionAgentTool(BaseTool):
     description: str = "Analyzes a baseline and current image to find differences and structural damage."
     args_schema: Type[BaseModel] = PerceptionToolInput
     
-    baseline: Tuple[Optional[bytes], Optional[str]]
-    current: Tuple[Optional[bytes], Optional[str]]
+    baseline: ImageInput
+    current: ImageInput
 
     def _run(self, instruction: Optional[str] = None) -> PerceptionOutput:
         """Executes the tool by passing image bytes and instruction to the AI."""
         logger.info(f"Running PerceptionAgentTool with instruction: {instruction}")
-        differences_raw = call_gemini_ensemble(self.baseline, self.current, view_label=instruction)
+        # Re-analysis passes (instruction set) want a fresh sample, not the cached first pass.
+        differences_raw = call_gemini_ensemble(
+            self.baseline, self.current, view_label=instruction, use_cache=instruction is None
+        )
+        failed = differences_raw is None
+        if failed:
+            logger.error("PerceptionAgentTool: Gemini analysis failed")
+            differences_raw = []
         
         overall_confidence = 0.0
         max_severity = "LOW"
@@ -74,7 +82,8 @@ class PerceptionAgentTool(BaseTool):
         return PerceptionOutput(
             differences=differences_raw,
             overall_confidence=overall_confidence,
-            max_severity=max_severity
+            max_severity=max_severity,
+            failed=failed
         )
 
 # ---------------------------------------------------------
@@ -159,12 +168,9 @@ def log_to_blockchain(decision_data: DecisionOutput):
 class AgentOrchestrator:
     """Manages the collaborative interaction between Perception and Reasoning agents."""
     def __init__(self, baseline_bytes: bytes, current_bytes: bytes, baseline_mime: str = "image/jpeg", current_mime: str = "image/jpeg"):
-        baseline_tuple = (baseline_bytes, baseline_mime)
-        current_tuple = (current_bytes, current_mime)
-        
         self.perception_tool = PerceptionAgentTool(
-            baseline=baseline_tuple, 
-            current=current_tuple
+            baseline=ImageInput(baseline_bytes, baseline_mime),
+            current=ImageInput(current_bytes, current_mime)
         )
         self.reasoning_agent = ReasoningAgent()
         
@@ -273,5 +279,6 @@ class AgentOrchestrator:
             "final_decision": final_decision.decision if final_decision else "ERROR",
             "iterations": max((int(log.get("iteration", 0)) for log in audit_log if log.get("step") == "reasoning"), default=0),
             "final_differences": final_perception.differences if final_perception else [],
+            "perception_failed": final_perception.failed if final_perception else True,
             "audit_log": audit_log
         }
@@ -1,11 +1,20 @@
+import io
 import os
 import json
 import re
+import time
+import random
+import hashlib
 import logging
+import mimetypes
+import tempfile
+import threading
 import traceback
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List, Optional, Tuple
 
-from .schema import RESPONSE_SCHEMA
+from .schema import DIFFERENCE_ITEM_SCHEMA, RESPONSE_SCHEMA
 
 logger = logging.getLogger(__name__)
 
@@ -17,13 +26,73 @@ except Exception as e:
     logger.error("[ai.py] google.generativeai import FAILED: %s", e)
 
 try:
-    from jsonschema import validate, ValidationError
+    from google.api_core import exceptions as api_exceptions
+    # Transient failures worth retrying; anything else (e.g. InvalidArgument) fails fast.
+    _RETRYABLE_ERRORS: Tuple[type, ...] = (
+        api_exceptions.ResourceExhausted,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+    )
+except Exception:
+    _RETRYABLE_ERRORS = ()
+
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = None
+    ImageOps = None
+    logger.warning("[ai.py] Pillow not available — images sent to Gemini unmodified")
+
+try:
+    import ijson
+except Exception:
+    ijson = None
+    logger.warning("[ai.py] ijson not available — streamed responses parsed once complete")
+
+try:
+    from cachetools import LRUCache, TTLCache
+except Exception:
+    LRUCache = None
+    TTLCache = None
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+    logger.info("[ai.py] orjson imported OK")
+except Exception:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+    logger.warning("[ai.py] orjson not available — using stdlib json")
+
+try:
+    from jsonschema import Draft202012Validator, ValidationError
+    # Build the validator once: jsonschema.validate() re-checks the schema and
+    # rebuilds a validator on every call.
+    _VALIDATOR = Draft202012Validator(RESPONSE_SCHEMA)
     logger.info("[ai.py] jsonschema imported OK")
 except Exception:
-    validate = None
+    _VALIDATOR = None
     ValidationError = Exception
     logger.warning("[ai.py] jsonschema not available — schema validation disabled")
 
+try:
+    import fastjsonschema
+    # Compile RESPONSE_SCHEMA into a specialised Python function once at import.
+    _FAST_VALIDATE = fastjsonschema.compile(RESPONSE_SCHEMA)
+    JsonSchemaException = fastjsonschema.JsonSchemaException
+    logger.info("[ai.py] fastjsonschema imported OK")
+except Exception:
+    _FAST_VALIDATE = None
+    JsonSchemaException = ValidationError
+    logger.warning("[ai.py] fastjsonschema not available — falling back to jsonschema")
+
+_VALIDATE = _FAST_VALIDATE or (_VALIDATOR.validate if _VALIDATOR is not None else None)
+_SCHEMA_ERRORS = (JsonSchemaException, ValidationError)
+
 
 def _configure_genai():
     api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
@@ -34,7 +103,7 @@ def _configure_genai():
         return False
     # Strip quotes in case .env file wraps them
     api_key = api_key.strip().strip('"').strip("'")
-    logger.info("[ai.py] Configuring genai with key starting: %s...", api_key[:10])
+    logger.info("[ai.py] Configuring genai with key starting: %.10s...", api_key)
     genai.configure(api_key=api_key)
     return True
 
@@ -59,7 +128,50 @@ FEW_SHOT = (
     "    }\n  ]\n}"
 )
 
+# Static prompt text, built once at import instead of on every request.
+_SYSTEM_PROMPT_HEAD = (
+    "You are an expert multimodal forensic analyst specializing in package integrity and tampering detection.\n"
+    "\nMISSION: Compare baseline vs current package photos to detect security breaches and integrity violations.\n"
+    "\nCRITICAL FOCUS:\n"
+    "- STRICTLY ignore the background of the image. ONLY focus on the box itself.\n"
+    "- STRICTLY ignore differences in camera angle, lighting, or perspective.\n"
+    "- STRICTLY ignore small, minor changes (e.g., tiny specks, minor scratches, slight color variations).\n"
+    "- STRICTLY ignore any tapes, tape peeling, or tape misalignments on the box.\n"
+    "- ONLY flag MAJOR structural changes such as edge distortion, corner distortion, dents, or severe damage.\n"
+    "\nDETECTION TARGETS:\n"
+    "- repackaging: Different packaging, missing elements, or structural changes\n"
+    "- label_mismatch: Altered, replaced, or counterfeit labels\n"
+    "- digital_edit: Photo manipulation, cloning, or artificial modifications\n"
+    "- dent: Physical damage from impact or compression\n"
+    "- edge_distortion: Significant crushing, bending, or damage to the edges\n"
+    "- corner_distortion: Significant crushing or damage to the corners\n"
+    "\nREGION SPECIFICATION:\n"
+    "Be VERY specific about damage locations:\n"
+    "- 'left side': Left edge/panel of the package\n"
+    "- 'right side': Right edge/panel of the package\n"
+    "- 'top edge': Upper portion/seal area\n"
+    "- 'bottom edge': Lower portion/base\n"
+    "- 'front panel': Main visible surface\n"
+    "- 'back panel': Rear surface\n"
+    "- 'corner': Specific corner (top-left, top-right, etc.)\n"
+    "- 'center': Middle area of package\n"
+    "\nANALYSIS RULES:\n"
+    "1. Return STRICT JSON: {\"differences\":[...]} with NO additional text\n"
+    "2. Focus ONLY on major issues: edge_distortion, corner_distortion, and dent.\n"
+    "3. Provide precise bbox coordinates [x,y,w,h] in 0..1 range\n"
+    "4. Use HIGH severity for security breaches, MEDIUM for major damage.\n"
+    "5. Confidence must reflect certainty: >0.8 for clear evidence, <0.6 for uncertain\n"
+    "6. TIS delta: repackaging(-33.4), edge_distortion(-23.3), corner_distortion(-20.5), dent(-17), digital_edit(-22), labeling(-33)\n"
+    "7. ALWAYS specify exact region - never use generic terms\n"
+)
+_SYSTEM_PROMPT = _SYSTEM_PROMPT_HEAD + "\n" + FEW_SHOT
+_FOCUS_REMINDER = (
+    "\nCRITICAL: Focus ONLY on the box and major security threats or structural damage. Ignore background, camera angle, minor changes, and ALL loose/missing tapes.\n"
+    "An edge distortion, corner distortion, or dent should trigger an alert.\n"
+    "\nBaseline Image (Reference):"
+)
 
+_RETRY_DELAY_RE = re.compile(r"retry in (\d+(\.\d+)?)s")
 
 
 def _build_model(name: str):
@@ -73,159 +185,513 @@ def _build_model(name: str):
     return genai.GenerativeModel(name, generation_config=generation_config)
 
 
-def _extract_json(text: str) -> Dict[str, Any]:
+PRIMARY_MODEL_NAME = "gemini-2.5-flash"
+# Smaller, cheaper model used for the last attempt once the primary keeps failing.
+FALLBACK_MODEL_NAME = os.getenv("BOXITY_FALLBACK_MODEL", "gemini-2.5-flash-lite")
+
+_MODELS: Dict[str, Any] = {}
+_MODEL_LOCK = threading.Lock()
+
+
+def _get_model(name: str = PRIMARY_MODEL_NAME):
+    """Return the shared GenerativeModel for name, configuring genai on first use.
+
+    Returns None if genai cannot be configured; the next call tries again.
+    """
+    model = _MODELS.get(name)
+    if model is None:
+        with _MODEL_LOCK:
+            model = _MODELS.get(name)
+            if model is None and _configure_genai():
+                model = _MODELS[name] = _build_model(name)
+    return model
+
+
+def warmup() -> bool:
+    """Run one-time Gemini setup ahead of the first request.
+
+    Configures genai, builds the shared model and exercises the schema validator.
+    Returns False if genai could not be configured.
+    """
+    if _VALIDATE is not None:
+        _VALIDATE({"differences": []})
+    return _get_model() is not None
+
+
+# Longest edge sent to Gemini. Its vision encoder tiles at a lower resolution
+# anyway, so larger uploads only cost bandwidth.
+_PREP_MAX_EDGE = 1536
+# Only downscaled results are cached, sized by their encoded bytes; images that
+# pass through unchanged are cheap to re-check and would pin the full upload.
+_PREP_CACHE_MAX_BYTES = 32 * 1024 * 1024
+_PREP_CACHE = (LRUCache(maxsize=_PREP_CACHE_MAX_BYTES, getsizeof=lambda v: len(v[0]))
+               if LRUCache is not None else None)
+_PREP_CACHE_LOCK = threading.Lock()
+
+
+def _prep_image(data: bytes, mime: str) -> Tuple[bytes, str]:
+    """Downscale an image to _PREP_MAX_EDGE and re-encode it as JPEG (q=85).
+
+    Images already within bounds, or that Pillow cannot decode, pass through unchanged.
+    """
+    if Image is None:
+        return data, mime
+    key = hashlib.blake2b(data, digest_size=16).digest()
+    if _PREP_CACHE is not None:
+        with _PREP_CACHE_LOCK:
+            cached = _PREP_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    result = (data, mime)
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            if max(im.size) > _PREP_MAX_EDGE:
+                im = ImageOps.exif_transpose(im)
+                im.thumbnail((_PREP_MAX_EDGE, _PREP_MAX_EDGE), Image.LANCZOS)
+                if im.mode != "RGB":
+                    im = im.convert("RGB")
+                buf = io.BytesIO()
+                im.save(buf, "JPEG", quality=85, optimize=True)
+                if buf.tell() < len(data):
+                    result = (buf.getvalue(), "image/jpeg")
+    except Exception as e:
+        logger.warning("[ai.py] Image downscale failed: %s — sending original", e)
+        return data, mime
+
+    logger.info("[ai.py] Prepared image: %d -> %d bytes", len(data), len(result[0]))
+    if _PREP_CACHE is not None and result[0] is not data:
+        with _PREP_CACHE_LOCK:
+            _PREP_CACHE[key] = result
+    return result
+
+
+# Files API handles keyed by image content hash. Retries and re-analyses of the
+# same image then reference the uploaded file by URI instead of re-sending bytes.
+# Uploaded files are never deleted here: another request may still hold the
+# handle, so they are left to expire server-side (48h). Entries are dropped a
+# little ahead of that so a cached handle never points at an expired file.
+_FILE_TTL = timedelta(hours=47)
+_FILE_CACHE = (TTLCache(maxsize=512, ttl=_FILE_TTL.total_seconds())
+               if TTLCache is not None else None)
+_FILE_CACHE_LOCK = threading.Lock()
+_FILE_EXPIRY_MARGIN = timedelta(minutes=5)
+
+
+def _file_is_live(handle: Any, now: datetime) -> bool:
+    expires = getattr(handle, "expiration_time", None)
+    return expires is not None and expires - _FILE_EXPIRY_MARGIN > now
+
+
+def _image_part(data: bytes, mime: str) -> Any:
+    """Return a Files API handle for the image, uploading it on first use.
+
+    Falls back to an inline image part if the upload fails.
+    """
+    key = hashlib.blake2b(data, digest_size=16).digest()
+    handle = None
+    if _FILE_CACHE is not None:
+        with _FILE_CACHE_LOCK:
+            handle = _FILE_CACHE.get(key)
+            if handle is not None and not _file_is_live(handle, datetime.now(timezone.utc)):
+                del _FILE_CACHE[key]
+                handle = None
+    if handle is not None:
+        logger.info("[ai.py] Reusing uploaded file %s", handle.name)
+        return handle
+
+    try:
+        # genai.upload_file only accepts a path in this SDK version.
+        with tempfile.NamedTemporaryFile(suffix=mimetypes.guess_extension(mime) or "") as tmp:
+            tmp.write(data)
+            tmp.flush()
+            handle = genai.upload_file(tmp.name, mime_type=mime)
+    except Exception as e:
+        logger.warning("[ai.py] Files API upload failed: %s — sending image inline", e)
+        return {"mime_type": mime, "data": data}
+
+    logger.info("[ai.py] Uploaded %d bytes as %s", len(data), handle.name)
+    if _FILE_CACHE is not None:
+        with _FILE_CACHE_LOCK:
+            _FILE_CACHE[key] = handle
+    return handle
+
+
+def _json_object_span(text: str) -> Optional[Tuple[int, int]]:
+    """Return (start, end) of the first balanced {...} object in text, skipping braces inside strings."""
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+    return None
+
+
+_PARSE_CACHE = LRUCache(maxsize=256) if LRUCache is not None else None
+_PARSE_CACHE_LOCK = threading.Lock()
+
+
+def _extract_json(text: str) -> Optional[Dict[str, Any]]:
+    """Parse a Gemini response, memoized by a hash of the text.
+
+    Returns None if the text holds no parseable JSON; failures are not memoized.
+    """
+    if _PARSE_CACHE is None or not text:
+        return _parse_json_text(text)
+    key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    with _PARSE_CACHE_LOCK:
+        payload = _PARSE_CACHE.get(key)
+    if payload is None:
+        payload = _parse_json_text(text)
+        if payload is not None:
+            with _PARSE_CACHE_LOCK:
+                _PARSE_CACHE[key] = payload
+    return payload
+
+
+def _parse_json_text(text: str) -> Optional[Dict[str, Any]]:
+    # Fast path: with response_mime_type=application/json Gemini almost always
+    # returns a bare object, which needs no stripping or scanning.
+    if text and text.startswith("{") and text.endswith("}"):
+        try:
+            return _json_loads(text)
+        except Exception:
+            pass
     text = (text or "").strip()
     if not text:
-        return {"differences": []}
+        logger.error("[ai.py] Empty Gemini response")
+        return None
     if text.startswith("```"):
-        text = re.sub(r"^```[a-zA-Z]*\n|\n```$", "", text)
-    if not text.lstrip().startswith('{'):
-        match = re.search(r"\{[\s\S]*\}", text)
-        text = match.group(0) if match else '{"differences": []}'
+        # Drop the opening fence line (```json) and the closing fence.
+        newline = text.find("\n")
+        text = text[newline + 1:] if newline != -1 else ""
+        if text.endswith("```"):
+            text = text[:text.rfind("```")]
+        text = text.strip()
+    if not text.startswith('{'):
+        span = _json_object_span(text)
+        if span is not None:
+            text = text[span[0]:span[1]]
+        else:
+            # Unbalanced: fall back to first '{' .. last '}'.
+            first, last = text.find("{"), text.rfind("}")
+            if first == -1 or last <= first:
+                logger.error("[ai.py] No JSON object in response — raw text: %s", text[:200])
+                return None
+            text = text[first:last + 1]
     try:
-        return json.loads(text)
+        return _json_loads(text)
     except Exception as e:
         logger.error("[ai.py] JSON parse failed: %s — raw text: %s", e, text[:200])
-        return {"differences": []}
+        return None
+
+
+_REQUIRED_DIFF_KEYS = frozenset(DIFFERENCE_ITEM_SCHEMA["required"])
 
 
-def _validate_or_repair(payload: Dict[str, Any], model) -> Dict[str, Any]:
-    if validate is None:
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_canonical(payload: Any) -> bool:
+    """Cheap check for the usual well-formed {"differences": [...]} shape.
+
+    Covers the required keys plus the types the normalizer converts
+    (confidence range, numeric tis_delta, explainability list, bbox) for the
+    items callers actually use; anything else goes through the full validator.
+    """
+    if not isinstance(payload, dict):
+        return False
+    differences = payload.get("differences")
+    if not isinstance(differences, list):
+        return False
+    for d in differences[:MAX_DIFFERENCES]:
+        if not isinstance(d, dict) or not _REQUIRED_DIFF_KEYS.issubset(d):
+            return False
+        confidence = d["confidence"]
+        if not _is_number(confidence) or not 0.0 <= confidence <= 1.0:
+            return False
+        if not _is_number(d["tis_delta"]) or not isinstance(d["explainability"], list):
+            return False
+        bbox = d.get("bbox")
+        if bbox is not None and not (isinstance(bbox, list) and len(bbox) == 4 and all(map(_is_number, bbox))):
+            return False
+    return True
+
+
+def _validate_or_repair(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Return payload if it matches the schema, else a Gemini-repaired copy, or None if repair fails."""
+    if _VALIDATE is None or _is_canonical(payload):
         return payload
     try:
-        validate(instance=payload, schema=RESPONSE_SCHEMA)
+        _VALIDATE(payload)
         return payload
-    except ValidationError as ve:
+    except _SCHEMA_ERRORS as ve:
         logger.warning("[ai.py] Schema validation failed: %s — attempting repair", ve.message[:100] if hasattr(ve, 'message') else str(ve)[:100])
         try:
-            result = model.generate_content([
+            result = _get_model().generate_content([
                 "Repair this JSON to match the schema {differences:[...] with required fields}:",
-                json.dumps(payload)
+                _json_dumps(payload)
             ])
             repaired = _extract_json(result.text or "")
-            validate(instance=repaired, schema=RESPONSE_SCHEMA)
+            _VALIDATE(repaired)
             return repaired
         except Exception as e2:
             logger.error("[ai.py] Repair also failed: %s", e2)
-            return {"differences": []}
+            return None
 
 
-def call_gemini_ensemble(
-    baseline: Tuple[Optional[bytes], Optional[str]],
-    current: Tuple[Optional[bytes], Optional[str]],
-    view_label: Optional[str] = None,
-) -> List[Dict[str, Any]]:
-    logger.info("[ai.py] ====== call_gemini_ensemble START (view=%s) ======", view_label)
+@dataclass(frozen=True, slots=True)
+class ImageInput:
+    """Raw image bytes plus MIME type, as passed to call_gemini_ensemble."""
+    data: Optional[bytes]
+    mime: str = "image/jpeg"
 
-    if not _configure_genai():
-        logger.error("[ai.py] _configure_genai returned False — aborting")
-        return []
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data else 0
+
+
+# Only the first MAX_DIFFERENCES items of a response are ever used.
+MAX_DIFFERENCES = 8
+
+
+class _DifferenceStream:
+    """Accumulates streamed Gemini text and parses differences[] items as they complete.
+
+    Once MAX_DIFFERENCES items are in, the caller can stop reading the stream
+    and skip the tail tokens.
+    """
 
-    baseline_bytes, baseline_mime = baseline
-    current_bytes, current_mime = current
+    def __init__(self) -> None:
+        self.chunks: List[str] = []
+        self.items: List[Dict[str, Any]] = []
+        self._events = None
+        self._coro = None
+        if ijson is not None:
+            self._events = ijson.sendable_list()
+            self._coro = ijson.items_coro(self._events, "differences.item", use_float=True)
+
+    def feed(self, text: str) -> bool:
+        """Add a chunk of response text; returns True once enough items are parsed."""
+        self.chunks.append(text)
+        if self._coro is None:
+            return False
+        try:
+            self._coro.send(text.encode())
+        except Exception:
+            # Not a bare JSON object (e.g. fenced); leave it to _extract_json.
+            self._coro = None
+            return False
+        if self._events:
+            self.items.extend(self._events)
+            del self._events[:]
+        return len(self.items) >= MAX_DIFFERENCES
+
+    @property
+    def complete(self) -> bool:
+        return len(self.items) >= MAX_DIFFERENCES
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+
+def _prepare_call(
+    baseline: ImageInput,
+    current: ImageInput,
+    view_label: Optional[str],
+) -> Optional[Tuple[Any, List[Any]]]:
+    """Resolve the model and build the prompt parts, or None if the call cannot run."""
+    model = _get_model()
+    if model is None:
+        logger.error("[ai.py] _configure_genai returned False — aborting")
+        return None
 
     logger.info("[ai.py] baseline: %d bytes, mime=%s | current: %d bytes, mime=%s",
-                len(baseline_bytes) if baseline_bytes else 0, baseline_mime,
-                len(current_bytes) if current_bytes else 0, current_mime)
+                baseline.size, baseline.mime, current.size, current.mime)
 
-    if not baseline_bytes or not current_bytes:
+    if not baseline.data or not current.data:
         logger.error("[ai.py] Missing image bytes — aborting")
-        return []
-
-    view_context = f"\nVIEW CONTEXT: {view_label}\n" if view_label else ""
-
-    system = (
-        "You are an expert multimodal forensic analyst specializing in package integrity and tampering detection.\n"
-        "\nMISSION: Compare baseline vs current package photos to detect security breaches and integrity violations.\n"
-        "\nCRITICAL FOCUS:\n"
-        "- STRICTLY ignore the background of the image. ONLY focus on the box itself.\n"
-        "- STRICTLY ignore differences in camera angle, lighting, or perspective.\n"
-        "- STRICTLY ignore small, minor changes (e.g., tiny specks, minor scratches, slight color variations).\n"
-        "- STRICTLY ignore any tapes, tape peeling, or tape misalignments on the box.\n"
-        "- ONLY flag MAJOR structural changes such as edge distortion, corner distortion, dents, or severe damage.\n"
-        "\nDETECTION TARGETS:\n"
-        "- repackaging: Different packaging, missing elements, or structural changes\n"
-        "- label_mismatch: Altered, replaced, or counterfeit labels\n"
-        "- digital_edit: Photo manipulation, cloning, or artificial modifications\n"
-        "- dent: Physical damage from impact or compression\n"
-        "- edge_distortion: Significant crushing, bending, or damage to the edges\n"
-        "- corner_distortion: Significant crushing or damage to the corners\n"
-        "\nREGION SPECIFICATION:\n"
-        "Be VERY specific about damage locations:\n"
-        "- 'left side': Left edge/panel of the package\n"
-        "- 'right side': Right edge/panel of the package\n"
-        "- 'top edge': Upper portion/seal area\n"
-        "- 'bottom edge': Lower portion/base\n"
-        "- 'front panel': Main visible surface\n"
-        "- 'back panel': Rear surface\n"
-        "- 'corner': Specific corner (top-left, top-right, etc.)\n"
-        "- 'center': Middle area of package\n"
-        "\nANALYSIS RULES:\n"
-        "1. Return STRICT JSON: {\"differences\":[...]} with NO additional text\n"
-        "2. Focus ONLY on major issues: edge_distortion, corner_distortion, and dent.\n"
-        "3. Provide precise bbox coordinates [x,y,w,h] in 0..1 range\n"
-        "4. Use HIGH severity for security breaches, MEDIUM for major damage.\n"
-        "5. Confidence must reflect certainty: >0.8 for clear evidence, <0.6 for uncertain\n"
-        "6. TIS delta: repackaging(-33.4), edge_distortion(-23.3), corner_distortion(-20.5), dent(-17), digital_edit(-22), labeling(-33)\n"
-        "7. ALWAYS specify exact region - never use generic terms\n"
-        + view_context
-        + "\n" + FEW_SHOT
-    )
+        return None
+
+    baseline_bytes, baseline_mime = _prep_image(baseline.data, baseline.mime)
+    current_bytes, current_mime = _prep_image(current.data, current.mime)
+
+    if view_label:
+        system = f"{_SYSTEM_PROMPT_HEAD}\nVIEW CONTEXT: {view_label}\n\n{FEW_SHOT}"
+    else:
+        system = _SYSTEM_PROMPT
 
     parts = [
         system,
-        "\nCRITICAL: Focus ONLY on the box and major security threats or structural damage. Ignore background, camera angle, minor changes, and ALL loose/missing tapes.\n"
-        "An edge distortion, corner distortion, or dent should trigger an alert.\n"
-        "\nBaseline Image (Reference):", {"mime_type": baseline_mime or "image/jpeg", "data": baseline_bytes},
-        "\nCurrent Image (Under Analysis):", {"mime_type": current_mime or "image/jpeg", "data": current_bytes},
+        _FOCUS_REMINDER, _image_part(baseline_bytes, baseline_mime),
+        "\nCurrent Image (Under Analysis):", _image_part(current_bytes, current_mime),
     ]
+    return model, parts
+
+
+def _parse_differences(stream: _DifferenceStream) -> Optional[List[Dict[str, Any]]]:
+    """Return the validated differences, or None if the response could not be parsed or repaired."""
+    verbose = logger.isEnabledFor(logging.INFO)
+    raw_text = stream.text
+    if verbose:
+        logger.info("[ai.py] Gemini raw response (first 500 chars): %.500s", raw_text)
+
+    if stream.complete:
+        # Stopped early: the text is truncated, but the parsed items are whole.
+        payload = {"differences": stream.items[:MAX_DIFFERENCES]}
+    else:
+        payload = _extract_json(raw_text)
+        if payload is None:
+            return None
+    if verbose:
+        logger.info("[ai.py] Extracted JSON payload: %d differences found", len(payload.get("differences", [])))
+
+    validated = _validate_or_repair(payload)
+    if validated is None:
+        return None
+    result = validated.get("differences", [])[:MAX_DIFFERENCES]
+    logger.info("[ai.py] Final validated result: %d differences", len(result))
+    return result
+
+
+_MAX_RETRIES = 3
+_BASE_RETRY_DELAY = 2.0
+_MAX_RETRY_DELAY = 30.0
+
+
+def _retry_delay(exc: Exception, attempt: int) -> float:
+    # Extract retry delay if available, otherwise exponential backoff
+    sleep_time = _BASE_RETRY_DELAY * (2 ** attempt)
+    # Check if the error message provides a specific delay
+    match = _RETRY_DELAY_RE.search(str(exc))
+    if match:
+        sleep_time = float(match.group(1)) + 1.0  # Add 1s buffer
+    # Jitter spreads out concurrent retries; the cap keeps a request from stalling.
+    return min(_MAX_RETRY_DELAY, sleep_time + random.uniform(0, 0.5))
+
+
+def _model_for_attempt(model, attempt: int, max_retries: int):
+    if attempt == max_retries and attempt > 0:
+        fallback = _get_model(FALLBACK_MODEL_NAME)
+        if fallback is not None:
+            logger.warning("[ai.py] Final attempt — degrading to %s", FALLBACK_MODEL_NAME)
+            return fallback
+    return model
+
+
+def _call_with_retry(model, parts: List[Any], max_retries: int = _MAX_RETRIES) -> Optional[_DifferenceStream]:
+    """Stream a Gemini response, retrying transient errors. Returns None once retries run out."""
+    for attempt in range(max_retries + 1):
+        attempt_model = _model_for_attempt(model, attempt, max_retries)
+        try:
+            logger.info("[ai.py] Sending request to Gemini (model=%s) [Attempt %d/%d]...",
+                        attempt_model.model_name, attempt + 1, max_retries + 1)
+            stream = _DifferenceStream()
+            for chunk in attempt_model.generate_content(parts, stream=True):
+                if stream.feed(chunk.text or ""):
+                    logger.info("[ai.py] %d differences parsed — stopping stream early", MAX_DIFFERENCES)
+                    break
+            return stream
+        except _RETRYABLE_ERRORS as exc:
+            if attempt < max_retries:
+                sleep_time = _retry_delay(exc, attempt)
+                logger.warning("[ai.py] Gemini %s. Retrying in %.2fs... (Attempt %d/%d)",
+                               type(exc).__name__, sleep_time, attempt + 1, max_retries + 1)
+                time.sleep(sleep_time)
+            else:
+                logger.error("[ai.py] !!!!! GEMINI RETRIES EXHAUSTED after %d retries: %s", max_retries, exc)
+    return None
 
-    # Optimized for speed: Use gemini-2.0-flash
-    model = _build_model("gemini-2.5-flash")
 
-    max_retries = 3
-    base_delay = 2
+# Validated differences keyed on (baseline hash, current hash, view_label), so an
+# exact re-analysis of the same pair skips the Gemini call.
+_RESULT_CACHE = LRUCache(maxsize=128) if LRUCache is not None else None
+_RESULT_CACHE_LOCK = threading.Lock()
 
-    import time
-    from google.api_core import exceptions
 
-    for attempt in range(max_retries + 1):
-        try:
-            logger.info("[ai.py] Sending request to Gemini (model=gemini-2.0-flash) [Attempt %d/%d]...", attempt + 1, max_retries + 1)
-            response = model.generate_content(parts)
-            raw_text = response.text or ""
-            logger.info("[ai.py] Gemini raw response (first 500 chars): %s", raw_text[:500])
+def _result_key(baseline: ImageInput, current: ImageInput, view_label: Optional[str]) -> Optional[Tuple[bytes, bytes, Optional[str]]]:
+    if _RESULT_CACHE is None or not baseline.data or not current.data:
+        return None
+    return (
+        hashlib.blake2b(baseline.data, digest_size=16).digest(),
+        hashlib.blake2b(current.data, digest_size=16).digest(),
+        view_label,
+    )
 
-            payload = _extract_json(raw_text)
-            logger.info("[ai.py] Extracted JSON payload: %d differences found", len(payload.get("differences", [])))
 
-            validated = _validate_or_repair(payload, model)
-            result = validated.get("differences", [])[:8]
-            logger.info("[ai.py] Final validated result: %d differences", len(result))
-            logger.info("[ai.py] ====== call_gemini_ensemble END (view=%s) ======", view_label)
+def _cached_result(key: Optional[Tuple[bytes, bytes, Optional[str]]]) -> Optional[List[Dict[str, Any]]]:
+    if key is None:
+        return None
+    with _RESULT_CACHE_LOCK:
+        cached = _RESULT_CACHE.get(key)
+    if cached is None:
+        return None
+    logger.info("[ai.py] Result cache hit — skipping Gemini call")
+    return [dict(d) for d in cached]
 
-            return result
 
-        except exceptions.ResourceExhausted as exc:
-            if attempt < max_retries:
-                # Extract retry delay if available, otherwise exponential backoff
-                sleep_time = base_delay * (2 ** attempt)
-                # Check if the error message provides a specific delay
-                error_msg = str(exc)
-                match = re.search(r"retry in (\d+(\.\d+)?)s", error_msg)
-                if match:
-                    sleep_time = float(match.group(1)) + 1.0 # Add 1s buffer
-                
-                logger.warning("[ai.py] Quota exceeded (429). Retrying in %.2fs... (Attempt %d/%d)", sleep_time, attempt + 1, max_retries + 1)
-                time.sleep(sleep_time)
-                continue
-            else:
-                logger.error("[ai.py] !!!!! GEMINI QUOTA EXHAUSTED after %d retries: %s", max_retries, exc)
-                return []
-
-        except Exception as e:
-            logger.error("[ai.py] !!!!! GEMINI CALL EXCEPTION: %s", e)
-            logger.error("[ai.py] Full traceback:\n%s", traceback.format_exc())
-            return []
-    
-    return []
+def _store_result(key: Optional[Tuple[bytes, bytes, Optional[str]]], result: List[Dict[str, Any]]) -> None:
+    if key is not None:
+        with _RESULT_CACHE_LOCK:
+            _RESULT_CACHE[key] = [dict(d) for d in result]
+
+
+def call_gemini_ensemble(
+    baseline: ImageInput,
+    current: ImageInput,
+    view_label: Optional[str] = None,
+    use_cache: bool = True,
+) -> Optional[List[Dict[str, Any]]]:
+    """Compare baseline and current images with Gemini and return up to MAX_DIFFERENCES differences.
+
+    Returns None if the analysis failed (no model, retries exhausted, or an
+    unparseable response), so callers can tell a failure from a clean result.
+    With use_cache=False the result cache is neither read nor written, e.g. when
+    a fresh sample is wanted for a re-analysis.
+    """
+    logger.info("[ai.py] ====== call_gemini_ensemble START (view=%s) ======", view_label)
+
+    key = _result_key(baseline, current, view_label) if use_cache else None
+    cached = _cached_result(key)
+    if cached is not None:
+        return cached
+
+    prepared = _prepare_call(baseline, current, view_label)
+    if prepared is None:
+        return None
+    model, parts = prepared
+
+    try:
+        stream = _call_with_retry(model, parts)
+        if stream is None:
+            return None
+        result = _parse_differences(stream)
+        if result is None:
+            return None
+        _store_result(key, result)
+        logger.info("[ai.py] ====== call_gemini_ensemble END (view=%s) ======", view_label)
+        return result
+    except Exception as e:
+        logger.error("[ai.py] !!!!! GEMINI CALL EXCEPTION: %s", e)
+        logger.error("[ai.py] Full traceback:\n%s", traceback.format_exc())
+        return None
@@ -1,11 +1,16 @@
 # api/index.py — OpenCV preprocessing + Gemini analysis (one angle per call)
+import asyncio
 import logging
 import os
 import sys
 import traceback
 import json
 import io
-import base64
+import binascii
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Tuple
 from flask import Flask, request, jsonify
@@ -24,9 +29,29 @@ except Exception:
 # requests
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 except Exception:
     requests = None
 
+# cachetools (in-process URL cache)
+try:
+    from cachetools import TTLCache
+except Exception:
+    TTLCache = None
+
+# orjson (fast parsing of multi-MB base64 request bodies)
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# redis (optional analysis result cache)
+try:
+    import redis
+except Exception:
+    redis = None
+
 # google generative ai library
 try:
     import google.generativeai as genai
@@ -34,6 +59,14 @@ except Exception:
     genai = None
 
 # Gemini AI helper
+try:
+    from .ai import ImageInput, call_gemini_ensemble, warmup
+except Exception as e:
+    ImageInput = None
+    call_gemini_ensemble = None
+    warmup = None
+    print("Gemini helper import failed:", e, file=sys.stderr)
+
 try:
     from .agent import AgentOrchestrator
 except Exception as e:
@@ -61,51 +94,64 @@ except Exception as e:
     np = None
     print("numpy import failed:", str(e), file=sys.stderr)
 
+# PyTurboJPEG (optional faster JPEG encoder; needs the libturbojpeg shared library)
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+    _TJ = TurboJPEG()
+except Exception:
+    _TJ = None
+
 # Set up logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s')
+_LOG_LEVEL = os.getenv("BOXITY_LOG_LEVEL", "INFO").upper()
+# getLevelName maps known names to their int level (getLevelNamesMapping is 3.11+ only).
+_LOG_LEVEL_VALID = isinstance(logging.getLevelName(_LOG_LEVEL), int)
+logging.basicConfig(level=_LOG_LEVEL if _LOG_LEVEL_VALID else "INFO", format='%(asctime)s [%(levelname)s] %(message)s')
 logger = logging.getLogger(__name__)
+if not _LOG_LEVEL_VALID:
+    logger.warning("Unknown BOXITY_LOG_LEVEL %r, using INFO", _LOG_LEVEL)
 
 app = Flask(__name__)
 if CORS is not None:
-    CORS(app, resources={r"/analyze": {"origins": "*"}})
+    CORS(app, resources={r"/*": {"origins": "*"}},
+         methods=["GET", "POST", "OPTIONS"],
+         allow_headers=["Content-Type", "Authorization"],
+         max_age=600)
 
 SCORING_VERSION = "cv-gemini-v1"
 logger.info("=== api/index.py loaded === SCORING_VERSION=%s, cv2=%s, genai=%s, vision=%s",
             SCORING_VERSION, cv2 is not None, genai is not None, align_and_normalize is not None)
 
-@app.after_request
-def _add_cors_headers(response):
-    origin = request.headers.get("Origin")
-    if origin:
-        response.headers["Access-Control-Allow-Origin"] = origin
-        response.headers["Vary"] = "Origin"
-    else:
-        response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type,Authorization"
-    response.headers["Access-Control-Max-Age"] = "600"
-    return response
+# Redis cache of full /analyze results for identical image pairs.
+# Needs REDIS_URL; set BOXITY_CACHE_ENABLED=0 to turn it off (e.g. in tests).
+CACHE_TTL_SECONDS = 3600
+_CACHE = None
+if (redis is not None and os.getenv("REDIS_URL")
+        and os.getenv("BOXITY_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")):
+    try:
+        _CACHE = redis.Redis.from_url(os.getenv("REDIS_URL"), socket_timeout=1.0)
+    except Exception as e:
+        logger.error("Redis cache disabled: %s", e)
+
+# Configure genai and build the shared model at startup so the first /analyze
+# request does not pay for it. The API key is read from the environment once;
+# restart the process to rotate it.
+_GENAI_READY = False
+if warmup is not None:
+    try:
+        _GENAI_READY = warmup()
+    except Exception as e:
+        logger.error("Gemini warmup failed: %s", e)
+    logger.info("Gemini warmup: ready=%s", _GENAI_READY)
 
 IMAGE_PACK_DELIMITER = "||"
 
-# ── helpers ──────────────────────────────────────────────
+# Shared pools for image fetches and the blocking analysis pipeline. Flask gives
+# every async view a fresh event loop, so asyncio.to_thread would spin up (and
+# tear down) a new executor per request.
+_IO_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="boxity-io")
+_ANALYZE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="boxity-analyze")
 
-def _configure_genai():
-    api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        logger.error("No GOOGLE_API_KEY/GEMINI_API_KEY set in environment")
-        return False
-    if genai is None:
-        logger.error("google.generativeai not installed or failed to import")
-        return False
-    # Strip quotes in case .env wraps the value
-    api_key = api_key.strip().strip('"').strip("'")
-    try:
-        genai.configure(api_key=api_key)
-        return True
-    except Exception as e:
-        print("genai.configure error:", str(e), file=sys.stderr)
-        return False
+# ── helpers ──────────────────────────────────────────────
 
 @app.route('/')
 def home():
@@ -116,61 +162,147 @@ def about():
     return 'About'
 
 
-def _load_image_bytes(source: str) -> Tuple[Optional[bytes], Optional[str]]:
-    """Load image bytes and MIME type from a URL or base64 data URI."""
+def _sniff_mime(data: bytes) -> str:
+    """Guess the image MIME type from magic bytes (JPEG if unrecognized)."""
+    if data[:4] == b'\x89PNG':
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def _load_image_bytes(source: str, cache: bool = False) -> Tuple[Optional[bytes], Optional[str]]:
+    """Load image bytes and MIME type from a URL or base64 data URI.
+
+    With cache=True remote images go through the in-process URL cache.
+    """
     if not source:
         return None, None
     if source.startswith('data:'):
         try:
-            header, b64 = source.split(',', 1)
-            mime = header.split(';', 1)[0].replace('data:', '') or 'application/octet-stream'
-            return base64.b64decode(b64), mime
+            comma = source.find(',')
+            if comma == -1:
+                return None, None
+            semi = source.find(';', 5, comma)
+            mime = source[5:semi if semi != -1 else comma] or 'application/octet-stream'
+            # Slice the payload through a memoryview so the multi-MB base64
+            # body is not copied again before decoding.
+            payload = memoryview(source.encode('ascii'))[comma + 1:]
+            return binascii.a2b_base64(payload), mime
         except Exception:
             return None, None
     if len(source) > 256 and not source.startswith('http'):
         try:
-            return base64.b64decode(source), 'image/jpeg'
+            data = binascii.a2b_base64(source.encode('ascii'))
+            return data, _sniff_mime(data)
         except Exception:
             return None, None
-    if requests is None:
+    return _fetch_url(source, cache=cache)
+
+
+# Baselines are reused across many uploads (same product SKU), so remote
+# baseline images are cached briefly. Current images are always fetched fresh:
+# a re-upload to the same object key must not be checked against a stale photo.
+# The cache is bounded by total bytes; single responses over the per-entry
+# limit are not cached.
+_URL_CACHE_MAX_BYTES = 8 * 1024 * 1024
+_URL_CACHE_TOTAL_BYTES = 64 * 1024 * 1024
+_URL_CACHE = (TTLCache(maxsize=_URL_CACHE_TOTAL_BYTES, ttl=600, getsizeof=lambda v: len(v[0]))
+              if TTLCache is not None else None)
+_URL_CACHE_LOCK = threading.Lock()
+
+# One pooled session so repeat fetches from the same CDN/S3 host reuse
+# keep-alive connections instead of paying a TCP + TLS handshake each time.
+_HTTP = None
+if requests is not None:
+    _HTTP = requests.Session()
+    _HTTP.headers["User-Agent"] = f"boxity-backend/{SCORING_VERSION}"
+    _adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50,
+                           max_retries=Retry(total=2, backoff_factor=0.1))
+    _HTTP.mount("https://", _adapter)
+    _HTTP.mount("http://", _adapter)
+
+
+def _fetch_url(url: str, cache: bool = False) -> Tuple[Optional[bytes], Optional[str]]:
+    """Download an image; with cache=True repeat URLs are served from the in-process cache."""
+    cache = cache and _URL_CACHE is not None
+    if cache:
+        with _URL_CACHE_LOCK:
+            cached = _URL_CACHE.get(url)
+        if cached is not None:
+            return cached
+    if _HTTP is None:
         return None, None
     try:
-        resp = requests.get(source, timeout=20)
-        if resp.status_code == 200:
+        # Read the streamed body in one call; resp.content would join it from
+        # small chunks, costing an extra full-image copy.
+        with _HTTP.get(url, timeout=20, stream=True) as resp:
+            if resp.status_code != 200:
+                return None, None
             mime = resp.headers.get('Content-Type', '').split(';')[0] or None
-            return resp.content, mime
+            data = resp.raw.read(decode_content=True)
+        result = (data, mime)
+        if cache and len(data) <= _URL_CACHE_MAX_BYTES:
+            with _URL_CACHE_LOCK:
+                _URL_CACHE[url] = result
+        return result
     except Exception:
         return None, None
-    return None, None
+
+
+_DIFF_DEFAULTS: Dict[str, Any] = {
+    "id": "diff-unknown",
+    "region": "unknown",
+    "bbox": None,
+    "type": "other",
+    "description": "",
+    "severity": "LOW",
+    "confidence": 0.5,
+    "explainability": [],
+    "suggested_action": "Review",
+    "tis_delta": 0,
+}
 
 
 def _normalize_diff_item(item: Dict[str, Any]) -> Dict[str, Any]:
-    return {
-        "id": str(item.get("id")) if item.get("id") is not None else "diff-unknown",
-        "region": item.get("region") or "unknown",
-        "bbox": item.get("bbox"),
-        "type": item.get("type") or "other",
-        "description": item.get("description") or "",
-        "severity": item.get("severity") or "LOW",
-        "confidence": float(item.get("confidence") or 0.5),
-        "explainability": item.get("explainability") or [],
-        "suggested_action": item.get("suggested_action") or "Review",
-        "tis_delta": int(item.get("tis_delta") or 0),
-    }
+    # Only missing/None fields take defaults, so legitimate falsy values such
+    # as confidence=0.0 survive. Unknown keys from the model are dropped.
+    merged = dict(_DIFF_DEFAULTS)
+    merged.update((k, item[k]) for k in _DIFF_DEFAULTS if item.get(k) is not None)
+    merged["id"] = str(merged["id"])
+    merged["severity"] = str(merged["severity"]).upper()
+    merged["confidence"] = float(merged["confidence"])
+    merged["tis_delta"] = int(merged["tis_delta"])
+    explainability = merged["explainability"]
+    # A bare string (or other scalar) is one reason, not a sequence of them.
+    merged["explainability"] = list(explainability) if isinstance(explainability, (list, tuple)) else [str(explainability)]
+    return merged
 
 
 def _clamp(value: int, lo: int, hi: int) -> int:
     return max(lo, min(hi, value))
 
 
+_SEVERITY_WEIGHTS = {"HIGH": 1.0, "MEDIUM": 0.6, "LOW": 0.3}
+_EMPTY_OVERALL = (100, "SAFE", 0.95, "No differences detected - product integrity maintained")
+_SAFE_BAND = ("SAFE", "Product integrity maintained - safe to proceed")
+_MODERATE_BAND = ("MODERATE_RISK", "Moderate risk detected - supervisor review recommended")
+_HIGH_RISK_BAND = ("HIGH_RISK", "High risk detected - immediate quarantine required")
+_CRITICAL_TYPES = frozenset(("seal_tamper", "repackaging", "digital_edit"))
+
+
 def _compute_overall(differences: List[Dict[str, Any]]) -> Tuple[int, str, float, str]:
-    """Compute TIS score, assessment, confidence and notes from Gemini differences."""
+    """Compute TIS score, assessment, confidence and notes from Gemini differences.
+
+    Expects items already passed through _normalize_diff_item.
+    """
     if not differences:
-        return 100, "SAFE", 0.95, "No differences detected - product integrity maintained"
+        return _EMPTY_OVERALL
 
     tis = 100
     total_confidence = 0.0
-    severity_weights = {"HIGH": 1.0, "MEDIUM": 0.6, "LOW": 0.3}
     critical_issues = []
     high_severity_count = 0
     medium_severity_count = 0
@@ -178,8 +310,8 @@ def _compute_overall(differences: List[Dict[str, Any]]) -> Tuple[int, str, float
     for d in differences:
         try:
             tis += int(d.get("tis_delta", 0))
-            severity = str(d.get("severity", "LOW")).upper()
-            weight = severity_weights.get(severity, 0.3)
+            severity = d["severity"]
+            weight = _SEVERITY_WEIGHTS.get(severity, 0.3)
             confidence = float(d.get("confidence", 0.5))
             total_confidence += confidence * weight
             if severity == "HIGH":
@@ -188,7 +320,7 @@ def _compute_overall(differences: List[Dict[str, Any]]) -> Tuple[int, str, float
                 medium_severity_count += 1
             if severity == "HIGH" and confidence > 0.6:
                 issue_type = str(d.get("type", "unknown"))
-                if issue_type in ["seal_tamper", "repackaging", "digital_edit"]:
+                if issue_type in _CRITICAL_TYPES:
                     critical_issues.append(issue_type)
         except Exception:
             continue
@@ -199,11 +331,11 @@ def _compute_overall(differences: List[Dict[str, Any]]) -> Tuple[int, str, float
         tis = 1
 
     if tis >= 80:
-        assessment, notes = "SAFE", "Product integrity maintained - safe to proceed"
+        assessment, notes = _SAFE_BAND
     elif tis >= 40:
-        assessment, notes = "MODERATE_RISK", "Moderate risk detected - supervisor review recommended"
+        assessment, notes = _MODERATE_BAND
     else:
-        assessment, notes = "HIGH_RISK", "High risk detected - immediate quarantine required"
+        assessment, notes = _HIGH_RISK_BAND
 
     if critical_issues:
         if "seal_tamper" in critical_issues:
@@ -227,43 +359,79 @@ def _compute_overall(differences: List[Dict[str, Any]]) -> Tuple[int, str, float
 
 
 def _call_gemini(
-    baseline: Tuple[Optional[bytes], Optional[str]],
-    current: Tuple[Optional[bytes], Optional[str]],
+    baseline: "ImageInput",
+    current: "ImageInput",
     view_label: Optional[str] = None,
-) -> List[Dict[str, Any]]:
+) -> Optional[List[Dict[str, Any]]]:
+    """Run the Gemini diff and normalize its items; None if the analysis failed."""
     if call_gemini_ensemble is None:
-        print("Gemini module not loaded", file=sys.stderr)
-        return []
+        logger.error("Gemini module not loaded")
+        return None
     try:
         items = call_gemini_ensemble(baseline, current, view_label=view_label)
+        if items is None:
+            return None
         return [_normalize_diff_item(it) for it in items if isinstance(it, dict)]
     except Exception as e:
-        print(f"Gemini call failed for {view_label}: {e}", file=sys.stderr)
-        return []
+        logger.error("Gemini call failed for %s: %s", view_label, e)
+        return None
+
+
+# Gemini tiles images at ~768 px, so anything past ~1024 px on the long edge
+# only adds upload time. Quality 85 is still indistinguishable for the diff task.
+_MAX_EDGE = int(os.getenv("BOXITY_MAX_EDGE", "1024"))
+_JPEG_QUALITY = 85
+_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, _JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 0] if cv2 is not None else []
+
+
+# libjpeg releases the GIL, so the two independent encodes can use two cores.
+_ENC_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="boxity-enc")
+
+
+def _encode_jpeg(img: "np.ndarray") -> bytes:
+    img = _fit_max_edge(img)
+    if _TJ is not None:
+        # 4:2:0 chroma subsampling: ~35% smaller than 4:4:4 at the same quality.
+        return _TJ.encode(img, quality=_JPEG_QUALITY, jpeg_subsample=TJSAMP_420)
+    _, enc = cv2.imencode('.jpg', img, _JPEG_PARAMS)
+    return enc.tobytes()
+
+
+def _fit_max_edge(img: "np.ndarray") -> "np.ndarray":
+    h, w = img.shape[:2]
+    scale = _MAX_EDGE / max(h, w)
+    if scale >= 1.0:
+        return img
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
 
 def _preprocess_with_cv(baseline_bytes: bytes, current_bytes: bytes) -> Tuple[bytes, bytes]:
     """Use OpenCV to align and normalize images before sending to Gemini.
     
-    Returns the preprocessed image bytes (JPEG encoded).
-    Falls back to originals if OpenCV is unavailable or fails.
+    Returns the preprocessed image bytes (JPEG encoded). The originals are
+    returned untouched when alignment changed nothing, or if OpenCV is
+    unavailable or fails.
     """
-    logger.info("[PREPROCESS] Starting OpenCV preprocessing. cv2=%s, np=%s, align_fn=%s",
-                cv2 is not None, np is not None, align_and_normalize is not None)
+    logger.debug("[PREPROCESS] Starting OpenCV preprocessing. cv2=%s, np=%s, align_fn=%s",
+                 cv2 is not None, np is not None, align_and_normalize is not None)
     if cv2 is None or np is None or align_and_normalize is None:
         logger.warning("[PREPROCESS] OpenCV preprocessing unavailable, using raw images")
         return baseline_bytes, current_bytes
 
     try:
-        logger.info("[PREPROCESS] Calling align_and_normalize with %d / %d bytes",
-                    len(baseline_bytes), len(current_bytes))
-        b_norm, c_norm = align_and_normalize(baseline_bytes, current_bytes)
+        logger.debug("[PREPROCESS] Calling align_and_normalize with %d / %d bytes",
+                     len(baseline_bytes), len(current_bytes))
+        b_norm, c_norm, changed = align_and_normalize(baseline_bytes, current_bytes)
+        if b_norm is not None and c_norm is not None and not changed:
+            logger.debug("[PREPROCESS] Alignment was a no-op, keeping original bytes")
+            return baseline_bytes, current_bytes
         if b_norm is not None and c_norm is not None:
-            _, b_enc = cv2.imencode('.jpg', b_norm, [cv2.IMWRITE_JPEG_QUALITY, 95])
-            _, c_enc = cv2.imencode('.jpg', c_norm, [cv2.IMWRITE_JPEG_QUALITY, 95])
-            logger.info("[PREPROCESS] OpenCV preprocessing SUCCESSFUL. Output sizes: %d / %d bytes",
-                        len(b_enc.tobytes()), len(c_enc.tobytes()))
-            return b_enc.tobytes(), c_enc.tobytes()
+            b_future = _ENC_POOL.submit(_encode_jpeg, b_norm)
+            c_out = _encode_jpeg(c_norm)
+            b_out = b_future.result()
+            logger.info("[PREPROCESS] Encoded at max edge %d: baseline %d -> %d bytes, current %d -> %d bytes",
+                        _MAX_EDGE, len(baseline_bytes), len(b_out), len(current_bytes), len(c_out))
+            return b_out, c_out
         else:
             logger.warning("[PREPROCESS] align_and_normalize returned None, using raw images")
             return baseline_bytes, current_bytes
@@ -272,15 +440,83 @@ def _preprocess_with_cv(baseline_bytes: bytes, current_bytes: bytes) -> Tuple[by
         return baseline_bytes, current_bytes
 
 
+def _cache_key(baseline_bytes: bytes, current_bytes: bytes, view_label: str) -> str:
+    h = hashlib.sha256()
+    for part in (baseline_bytes, b"|", current_bytes, b"|", view_label.encode(), SCORING_VERSION.encode()):
+        h.update(part)
+    return "boxity:" + h.hexdigest()
+
+
+def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    if _CACHE is None:
+        return None
+    try:
+        cached = _CACHE.get(key)
+        return json.loads(cached) if cached else None
+    except Exception as e:
+        logger.warning("Redis cache read failed: %s", e)
+        return None
+
+
+def _cache_set(key: str, result: Dict[str, Any]) -> None:
+    if _CACHE is None:
+        return
+    try:
+        _CACHE.setex(key, CACHE_TTL_SECONDS, json.dumps(result))
+    except Exception as e:
+        logger.warning("Redis cache write failed: %s", e)
+
+
 # ── core analysis ────────────────────────────────────────
 
-def _analyze_pair(baseline_src: str, current_src: str, view_label: str) -> Dict[str, Any]:
-    """Analyze ONE angle: OpenCV preprocess → Agent Orchestrator (Perception & Reasoning) → TIS scoring."""
+# Re-uploads of the exact same file are a guaranteed perfect match. Tiny
+# payloads (such as the test suite's 1x1 PNG) still go through the full
+# pipeline so the end-to-end tests keep exercising it.
+_IDENTICAL_MIN_BYTES = 1024
+
+def _identical_pair_result(view_label: str) -> Dict[str, Any]:
+    tis, assessment, conf_overall, notes = _compute_overall([])
+    return {
+        "view": view_label,
+        "differences": [],
+        "aggregate_tis": tis,
+        "overall_assessment": assessment,
+        "confidence_overall": conf_overall,
+        "notes": notes,
+        "can_upload": True,
+        "agent_decision": "APPROVE",
+        "agent_iterations": 0,
+        "agent_audit_log": [],
+        "analysis_metadata": {
+            "total_differences": 0,
+            "high_severity_count": 0,
+            "medium_severity_count": 0,
+            "low_severity_count": 0,
+            "analysis_timestamp": str(datetime.now().isoformat()),
+            "scoring_version": SCORING_VERSION,
+            "gemini_diff_count": 0,
+            "cv_used": False,
+            "cache_hit": False,
+            "gemini_failed": False,
+            "fast_path": "identical_bytes",
+        },
+    }
+
+
+async def _analyze_pair(baseline_src: str, current_src: str, view_label: str) -> Dict[str, Any]:
+    """Analyze ONE angle: OpenCV preprocess → Agent Orchestrator (Perception & Reasoning) → TIS scoring.
+
+    Both images are fetched concurrently; the blocking pipeline runs in a worker
+    thread so the event loop is free while Gemini is working.
+    """
     logger.info("======== _analyze_pair START [%s] ========", view_label)
-    logger.info("[LOAD] Loading baseline image (first 80 chars): %s", baseline_src[:80] + "...")
-    baseline_bytes, baseline_mime = _load_image_bytes(baseline_src)
-    logger.info("[LOAD] Loading current image (first 80 chars): %s", current_src[:80] + "...")
-    current_bytes, current_mime = _load_image_bytes(current_src)
+    logger.debug("[LOAD] Loading baseline image (first 80 chars): %.80s...", baseline_src)
+    logger.debug("[LOAD] Loading current image (first 80 chars): %.80s...", current_src)
+    loop = asyncio.get_running_loop()
+    (baseline_bytes, baseline_mime), (current_bytes, current_mime) = await asyncio.gather(
+        loop.run_in_executor(_IO_POOL, _load_image_bytes, baseline_src, True),
+        loop.run_in_executor(_IO_POOL, _load_image_bytes, current_src),
+    )
 
     logger.info("[LOAD] baseline=%s bytes, mime=%s | current=%s bytes, mime=%s",
                 len(baseline_bytes) if baseline_bytes else 0, baseline_mime,
@@ -291,6 +527,37 @@ def _analyze_pair(baseline_src: str, current_src: str, view_label: str) -> Dict[
     if not current_bytes:
         raise ValueError(f"Failed to load current image for {view_label}")
 
+    if len(baseline_bytes) >= _IDENTICAL_MIN_BYTES and baseline_bytes == current_bytes:
+        logger.info("[FAST PATH] Identical baseline/current bytes for %s — skipping CV and Gemini", view_label)
+        return _identical_pair_result(view_label)
+
+    return await loop.run_in_executor(
+        _ANALYZE_POOL, _analyze_loaded_pair,
+        baseline_bytes, baseline_mime, current_bytes, current_mime, view_label,
+    )
+
+
+def _analyze_loaded_pair(
+    baseline_bytes: bytes,
+    baseline_mime: Optional[str],
+    current_bytes: bytes,
+    current_mime: Optional[str],
+    view_label: str,
+) -> Dict[str, Any]:
+    """Blocking part of _analyze_pair: cache lookup, OpenCV, agents and scoring."""
+    cache_key = _cache_key(baseline_bytes, current_bytes, view_label) if _CACHE is not None else None
+    if cache_key is not None:
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            logger.info("[CACHE] Hit for %s — skipping preprocessing and Gemini", view_label)
+            metadata = cached["analysis_metadata"]
+            # analysis_timestamp is the time of this request; cached_at says when
+            # the stored analysis was actually produced.
+            metadata["cached_at"] = metadata.get("analysis_timestamp")
+            metadata["analysis_timestamp"] = str(datetime.now().isoformat())
+            metadata["cache_hit"] = True
+            return cached
+
     cv_used = False
 
     # STEP 1: OpenCV preprocessing (alignment + normalization)
@@ -316,18 +583,22 @@ def _analyze_pair(baseline_src: str, current_src: str, view_label: str) -> Dict[
         )
         agent_output = orchestrator.execute()
         differences = agent_output.get("final_differences", [])
+        gemini_failed = bool(agent_output.get("perception_failed"))
         
         # Standardize differences
         differences = [_normalize_diff_item(it) for it in differences if isinstance(it, dict)]
     else:
         logger.warning("AgentOrchestrator not found, falling back to basic gemini call")
         differences = _call_gemini(
-            (prep_baseline, baseline_mime or "image/jpeg"),
-            (prep_current, current_mime or "image/jpeg"),
+            ImageInput(prep_baseline, baseline_mime or "image/jpeg"),
+            ImageInput(prep_current, current_mime or "image/jpeg"),
             view_label=view_label,
         )
+        gemini_failed = differences is None
+        if gemini_failed:
+            differences = []
 
-    logger.info("[STEP 2] Differences found: %d", len(differences))
+    logger.info("[STEP 2] Differences found: %d (gemini_failed=%s)", len(differences), gemini_failed)
 
     for d in differences:
         d["view"] = view_label
@@ -342,11 +613,12 @@ def _analyze_pair(baseline_src: str, current_src: str, view_label: str) -> Dict[
          tis = min(tis, 39)
          
     can_upload = bool(tis >= 40)
+    severity_counts = Counter(d["severity"] for d in differences)
     
     logger.info("======== _analyze_pair END [%s] ========", view_label)
 
     # Return standard shape + the new agentic nested properties
-    return {
+    result = {
         "view": view_label,
         "differences": differences,
         "aggregate_tis": tis,
@@ -359,24 +631,75 @@ def _analyze_pair(baseline_src: str, current_src: str, view_label: str) -> Dict[
         "agent_audit_log": agent_output.get("audit_log", []) if agent_output else [],
         "analysis_metadata": {
             "total_differences": len(differences),
-            "high_severity_count": len([d for d in differences if str(d.get("severity", "")).upper() == "HIGH"]),
-            "medium_severity_count": len([d for d in differences if str(d.get("severity", "")).upper() == "MEDIUM"]),
-            "low_severity_count": len([d for d in differences if str(d.get("severity", "")).upper() == "LOW"]),
+            "high_severity_count": severity_counts["HIGH"],
+            "medium_severity_count": severity_counts["MEDIUM"],
+            "low_severity_count": severity_counts["LOW"],
             "analysis_timestamp": str(datetime.now().isoformat()),
             "scoring_version": SCORING_VERSION,
             "gemini_diff_count": len(differences),
             "cv_used": cv_used,
+            "cache_hit": False,
+            "gemini_failed": gemini_failed,
         },
     }
+    # A failed analysis scores as a clean pass; never let Redis serve that
+    # to later requests for the same pair.
+    if cache_key is not None and not gemini_failed:
+        _cache_set(cache_key, result)
+    elif gemini_failed:
+        logger.warning("[CACHE] Not caching %s: Gemini analysis failed", view_label)
+    return result
 
 
 # ── route ────────────────────────────────────────────────
 
+def _read_json_body() -> Dict[str, Any]:
+    """Parse the request body as a JSON object, or {} if it is missing/invalid."""
+    raw = request.get_data(cache=False)
+    try:
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _json_response(payload: Dict[str, Any]):
+    if orjson is not None:
+        try:
+            return app.response_class(orjson.dumps(payload), mimetype="application/json")
+        except TypeError:
+            pass
+    return jsonify(payload)
+
+
+def _pair_response(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape an _analyze_pair result into the public /analyze response body."""
+    return {
+        "differences": result["differences"],
+        "aggregate_tis": result["aggregate_tis"],
+        "overall_assessment": result["overall_assessment"],
+        "confidence_overall": result["confidence_overall"],
+        "notes": result["notes"],
+        "can_upload": result["can_upload"],
+        "agent_decision": result.get("agent_decision", "APPROVE"),
+        "agent_iterations": result.get("agent_iterations", 1),
+        "agent_audit_log": result.get("agent_audit_log", []),
+        "analysis_metadata": {
+            **result["analysis_metadata"],
+            "gemini_ready": True,
+            "cv_available": bool(cv2 is not None),
+        },
+    }
+
+
 @app.route("/analyze", methods=["POST", "OPTIONS"])
-def analyze():
+async def analyze():
     """
     Accepts ONE pair of images (1 baseline + 1 current) per call.
     The frontend calls this twice — once for Angle 1, once for Angle 2.
+
+    Deprecated for multi-angle checks: use /analyze_batch, which analyzes
+    all angles concurrently in a single request.
     
     Expected JSON body:
       { "baseline_b64": "...", "current_b64": "...", "view_label": "angle_1" }
@@ -386,15 +709,14 @@ def analyze():
         if request.method == "OPTIONS":
             return ("", 204)
 
-        gemini_ready = _configure_genai()
-        if not gemini_ready:
-            return jsonify({
+        if not _GENAI_READY:
+            return _json_response({
                 "error": "Gemini API key missing or configuration failed.",
                 "differences": [], "aggregate_tis": 100,
                 "overall_assessment": "UNKNOWN",
             }), 500
 
-        data = request.get_json(silent=True) or {}
+        data = _read_json_body()
 
         # Accept a single pair of images
         baseline_src = (
@@ -414,45 +736,138 @@ def analyze():
         view_label = data.get("view_label", "single")
 
         if not baseline_src or not current_src:
-            return jsonify({
+            return _json_response({
                 "error": "Missing baseline or current image",
                 "differences": [], "aggregate_tis": 100,
                 "overall_assessment": "UNKNOWN",
             }), 400
 
-        result = _analyze_pair(str(baseline_src), str(current_src), view_label=str(view_label))
-
-        response = {
-            "differences": result["differences"],
-            "aggregate_tis": result["aggregate_tis"],
-            "overall_assessment": result["overall_assessment"],
-            "confidence_overall": result["confidence_overall"],
-            "notes": result["notes"],
-            "can_upload": result["can_upload"],
-            "agent_decision": result.get("agent_decision", "APPROVE"),
-            "agent_iterations": result.get("agent_iterations", 1),
-            "agent_audit_log": result.get("agent_audit_log", []),
-            "analysis_metadata": {
-                **result["analysis_metadata"],
-                "gemini_ready": True,
-                "cv_available": bool(cv2 is not None),
-            },
-        }
-        return jsonify(response)
+        result = await _analyze_pair(str(baseline_src), str(current_src), view_label=str(view_label))
+
+        return _json_response(_pair_response(result))
 
     except ValueError as ve:
-        return jsonify({
+        return _json_response({
             "error": str(ve),
             "differences": [], "aggregate_tis": 100,
             "overall_assessment": "UNKNOWN",
         }), 400
     except Exception as e:
         tb = traceback.format_exc()
-        print("Exception in /analyze:", tb, file=sys.stderr)
-        return jsonify({
+        logger.error("Exception in /analyze: %s", tb)
+        return _json_response({
             "error": "Analyzer internal error",
             "details": str(e),
             "traceback": tb,
             "differences": [], "aggregate_tis": 100,
             "overall_assessment": "UNKNOWN",
         }), 500
+
+
+MAX_BATCH_PAIRS = 4
+
+
+def _batch_pair_sources(pair: Any) -> Tuple[Optional[str], Optional[str]]:
+    if not isinstance(pair, dict):
+        return None, None
+    baseline = pair.get("baseline") or pair.get("baseline_b64") or pair.get("baseline_url")
+    current = pair.get("current") or pair.get("current_b64") or pair.get("current_url")
+    return (str(baseline) if baseline else None), (str(current) if current else None)
+
+
+_BATCH_SUMMED_METADATA = (
+    "total_differences", "high_severity_count", "medium_severity_count",
+    "low_severity_count", "gemini_diff_count",
+)
+
+
+def _batch_metadata(views: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine per-angle analysis_metadata: counts are summed, flags OR-ed (cache_hit AND-ed)."""
+    metas = [v["analysis_metadata"] for v in views]
+    return {
+        **{k: sum(m.get(k, 0) for m in metas) for k in _BATCH_SUMMED_METADATA},
+        "analysis_timestamp": str(datetime.now().isoformat()),
+        "scoring_version": SCORING_VERSION,
+        "cv_used": any(m.get("cv_used") for m in metas),
+        "cache_hit": all(m.get("cache_hit") for m in metas),
+        "gemini_failed": any(m.get("gemini_failed") for m in metas),
+        "gemini_ready": True,
+        "cv_available": bool(cv2 is not None),
+    }
+
+
+@app.route("/analyze_batch", methods=["POST", "OPTIONS"])
+async def analyze_batch():
+    """
+    Accepts every angle of a check in one call and analyzes them concurrently.
+
+    Expected JSON body:
+      { "pairs": [ { "baseline": "...", "current": "...", "view_label": "angle_1" }, ... ] }
+
+    The aggregate TIS is the lowest across angles (the worst angle decides),
+    and the differences of all angles are returned together, each tagged
+    with its "view". Agent iterations, audit logs and metadata counts are
+    combined across angles. Per-angle results are kept under "views".
+    """
+    try:
+        logger.info("===== /analyze_batch endpoint called, method=%s =====", request.method)
+        if request.method == "OPTIONS":
+            return ("", 204)
+
+        data = _read_json_body()
+        pairs = data.get("pairs")
+        sources = [_batch_pair_sources(p) for p in pairs] if isinstance(pairs, list) else []
+        if not sources or len(sources) > MAX_BATCH_PAIRS or not all(b and c for b, c in sources):
+            return _json_response({
+                "error": f"Expected 'pairs': 1-{MAX_BATCH_PAIRS} objects with baseline and current images",
+                "differences": [], "aggregate_tis": 100,
+                "overall_assessment": "UNKNOWN",
+            }), 400
+
+        if not _GENAI_READY:
+            return _json_response({
+                "error": "Gemini API key missing or configuration failed.",
+                "differences": [], "aggregate_tis": 100,
+                "overall_assessment": "UNKNOWN",
+            }), 500
+
+        results = await asyncio.gather(*(
+            _analyze_pair(baseline_src, current_src,
+                          view_label=str(pairs[i].get("view_label") or f"angle_{i + 1}"))
+            for i, (baseline_src, current_src) in enumerate(sources)
+        ))
+        for r in results:
+            for d in r["differences"]:
+                d["view"] = r["view"]
+        views = [_pair_response(r) for r in results]
+        worst = min(views, key=lambda v: v["aggregate_tis"])
+
+        return _json_response({
+            "differences": [d for v in views for d in v["differences"]],
+            "aggregate_tis": worst["aggregate_tis"],
+            "overall_assessment": worst["overall_assessment"],
+            "confidence_overall": sum(v["confidence_overall"] for v in views) / len(views),
+            "notes": worst["notes"],
+            "can_upload": all(v["can_upload"] for v in views),
+            "agent_decision": worst["agent_decision"],
+            "agent_iterations": sum(v["agent_iterations"] for v in views),
+            "agent_audit_log": [entry for v in views for entry in v["agent_audit_log"]],
+            "analysis_metadata": _batch_metadata(views),
+            "views": views,
+        })
+
+    except ValueError as ve:
+        return _json_response({
+            "error": str(ve),
+            "differences": [], "aggregate_tis": 100,
+            "overall_assessment": "UNKNOWN",
+        }), 400
+    except Exception as e:
+        tb = traceback.format_exc()
+        logger.error("Exception in /analyze_batch: %s", tb)
+        return _json_response({
+            "error": "Analyzer internal error",
+            "details": str(e),
+            "differences": [], "aggregate_tis": 100,
+            "overall_assessment": "UNKNOWN",
+        }), 500
@@ -1,4 +1,4 @@
-import sys
+import logging
 from typing import Any, Dict, List, Optional, Tuple
 
 try:
@@ -8,22 +8,34 @@ except Exception:
     cv2 = None
     np = None
 
+logger = logging.getLogger(__name__)
 
-def align_and_normalize(b_bytes: bytes, c_bytes: bytes) -> Tuple[Optional["cv2.Mat"], Optional["cv2.Mat"]]:
-    """Enhanced image alignment and normalization for better comparison accuracy."""
+
+def align_and_normalize(b_bytes: bytes, c_bytes: bytes) -> Tuple[Optional["cv2.Mat"], Optional["cv2.Mat"], bool]:
+    """Enhanced image alignment and normalization for better comparison accuracy.
+
+    The third element reports whether any pixels were changed. When it is
+    False the decoded images are identical to the inputs, so callers can keep
+    the original bytes (and MIME types) instead of re-encoding.
+    """
     if cv2 is None:
-        return None, None
+        return None, None, False
     
+    changed = False
     try:
         b_arr = np.frombuffer(b_bytes, dtype=np.uint8)
         c_arr = np.frombuffer(c_bytes, dtype=np.uint8)
         b = cv2.imdecode(b_arr, cv2.IMREAD_COLOR)
         c = cv2.imdecode(c_arr, cv2.IMREAD_COLOR)
         if b is None or c is None:
-            return None, None
+            return None, None, False
             
         h, w = b.shape[:2]
-        c_resized = cv2.resize(c, (w, h), interpolation=cv2.INTER_AREA)
+        if c.shape[:2] != (h, w):
+            c_resized = cv2.resize(c, (w, h), interpolation=cv2.INTER_AREA)
+            changed = True
+        else:
+            c_resized = c
 
         # Enhanced feature-based alignment with multiple detectors
         # Use multiple feature detectors for better alignment
@@ -73,9 +85,10 @@ def align_and_normalize(b_bytes: bytes, c_bytes: bytes) -> Tuple[Optional["cv2.M
         # Apply best homography if found
         if best_homography is not None and best_match_count >= 8:
             c_resized = cv2.warpPerspective(c_resized, best_homography, (w, h))
+            changed = True
 
     except Exception as e:
-        print(f"Alignment failed: {e}", file=sys.stderr)
+        logger.warning("Alignment failed: %s", e)
         pass
 
     # Enhanced illumination normalization
@@ -83,6 +96,7 @@ def align_and_normalize(b_bytes: bytes, c_bytes: bytes) -> Tuple[Optional["cv2.M
         # Convert to LAB color space for better perceptual uniformity
         if c_resized.shape[:2] != b.shape[:2]:
              c_resized = cv2.resize(c_resized, (b.shape[1], b.shape[0]))
+             changed = True
         
         b_lab = cv2.cvtColor(b, cv2.COLOR_BGR2LAB)
         c_lab = cv2.cvtColor(c_resized, cv2.COLOR_BGR2LAB)
@@ -105,11 +119,11 @@ def align_and_normalize(b_bytes: bytes, c_bytes: bytes) -> Tuple[Optional["cv2.M
         c_eq = cv2.equalizeHist(c_gray)
         c_norm = cv2.addWeighted(c_norm, 0.8, cv2.cvtColor(c_eq, cv2.COLOR_GRAY2BGR), 0.2, 0)
 
-        return b_norm, c_norm
+        return b_norm, c_norm, True
 
     except Exception as e:
-        print(f"Normalization steps failed: {e}", file=sys.stderr)
+        logger.warning("Normalization steps failed: %s", e)
         # Fallback to just returning the resized images if normalization fails
-        return b, c_resized
+        return b, c_resized, changed
 
 
@@ -1,13 +1,16 @@
 import unittest
+import asyncio
 import json
 import base64
 import os
 import sys
+from unittest import mock
 
 # Add the directory containing the app to the path so we can import it
 sys.path.append(os.getcwd())
 
-from api.index import app
+from api.index import app, _normalize_diff_item
+from api import ai, index
 
 class TestAnalyzeEndpoint(unittest.TestCase):
     def setUp(self):
@@ -35,6 +38,35 @@ class TestAnalyzeEndpoint(unittest.TestCase):
         self.assertIn('can_upload', data)
         self.assertTrue(data['can_upload'])
 
+    def test_identical_bytes_skip_gemini(self):
+        """Byte-identical uploads of 1 KiB or more are a perfect match without preprocessing or Gemini."""
+        large_png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 2048
+        large_b64 = "data:image/png;base64," + base64.b64encode(large_png).decode()
+        with mock.patch.object(index, "_GENAI_READY", True), \
+                mock.patch.object(index, "_preprocess_with_cv") as preprocess, \
+                mock.patch.object(index, "call_gemini_ensemble") as gemini:
+            response = self.app.post('/analyze',
+                                     data=json.dumps({"baseline": large_b64, "current": large_b64}),
+                                     content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['aggregate_tis'], 100)
+        self.assertTrue(data['can_upload'])
+        self.assertEqual(data['analysis_metadata']['fast_path'], 'identical_bytes')
+        preprocess.assert_not_called()
+        gemini.assert_not_called()
+
+    def test_tiny_identical_bytes_take_the_full_pipeline(self):
+        with mock.patch.object(index, "_GENAI_READY", True), \
+                mock.patch.object(index, "AgentOrchestrator", None), \
+                mock.patch.object(index, "call_gemini_ensemble", return_value=[]) as gemini:
+            response = self.app.post('/analyze',
+                                     data=json.dumps({"baseline": self.valid_b64, "current": self.valid_b64}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('fast_path', json.loads(response.data)['analysis_metadata'])
+        gemini.assert_called_once()
+
     def test_normalization_failure_repro(self):
         """Try to trigger normalization failed with empty/bad images if possible, 
         or at least verify how it handles garbage data."""
@@ -69,5 +101,283 @@ class TestAnalyzeEndpoint(unittest.TestCase):
                                  content_type='application/json')
         self.assertEqual(response.status_code, 200)
 
+    def test_analyze_batch_rejects_missing_pairs(self):
+        """The batch endpoint validates its body before touching Gemini."""
+        for payload in ({}, {"pairs": []}, {"pairs": [{"baseline": self.valid_b64}]}):
+            response = self.app.post('/analyze_batch',
+                                     data=json.dumps(payload),
+                                     content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data)['overall_assessment'], 'UNKNOWN')
+
+class TestAnalyzeBatch(unittest.TestCase):
+    @staticmethod
+    def _result(view_label, tis, can_upload, n_diffs, delay):
+        async def fake():
+            await asyncio.sleep(delay)
+            return {
+                "view": view_label,
+                "differences": [{"id": f"{view_label}-{i}", "severity": "LOW"} for i in range(n_diffs)],
+                "aggregate_tis": tis, "overall_assessment": "SAFE" if tis >= 80 else "HIGH_RISK",
+                "confidence_overall": 0.8, "notes": f"notes {view_label}", "can_upload": can_upload,
+                "agent_decision": "APPROVE", "agent_iterations": 1, "agent_audit_log": [view_label],
+                "analysis_metadata": {"total_differences": n_diffs, "low_severity_count": n_diffs,
+                                      "cache_hit": False, "cv_used": False},
+            }
+        return fake()
+
+    def test_aggregates_views(self):
+        """Worst TIS wins, can_upload is AND-ed, differences keep their view and views keep request order."""
+        outcomes = {"angle_1": (90, True, 1, 0.05), "angle_2": (30, False, 2, 0.0)}
+
+        async def fake_analyze_pair(baseline_src, current_src, view_label):
+            return await self._result(view_label, *outcomes[view_label])
+
+        with mock.patch.object(index, "_GENAI_READY", True), \
+                mock.patch.object(index, "_analyze_pair", fake_analyze_pair):
+            response = app.test_client().post('/analyze_batch', data=json.dumps({"pairs": [
+                {"baseline": "b1", "current": "c1", "view_label": "angle_1"},
+                {"baseline": "b2", "current": "c2"},
+            ]}), content_type='application/json')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["aggregate_tis"], 30)
+        self.assertEqual(data["notes"], "notes angle_2")
+        self.assertFalse(data["can_upload"])
+        self.assertEqual([d["view"] for d in data["differences"]], ["angle_1", "angle_2", "angle_2"])
+        self.assertEqual([v["aggregate_tis"] for v in data["views"]], [90, 30])
+        self.assertEqual(data["agent_iterations"], 2)
+        self.assertEqual(data["agent_audit_log"], ["angle_1", "angle_2"])
+        self.assertEqual(data["analysis_metadata"]["total_differences"], 3)
+
+class TestAnalyzeCacheHit(unittest.TestCase):
+    def test_cache_hit_skips_gemini(self):
+        """A Redis hit is returned as-is apart from cache_hit and the timestamps."""
+        stored = {
+            "view": "single", "differences": [], "aggregate_tis": 100,
+            "overall_assessment": "SAFE", "confidence_overall": 0.95,
+            "notes": "cached", "can_upload": True,
+            "analysis_metadata": {"analysis_timestamp": "2020-01-01T00:00:00", "cache_hit": False},
+        }
+        cache = mock.Mock()
+        cache.get.return_value = json.dumps(stored)
+        with mock.patch.object(index, "_CACHE", cache), \
+                mock.patch.object(index, "_GENAI_READY", True), \
+                mock.patch.object(index, "_preprocess_with_cv") as preprocess, \
+                mock.patch.object(index, "call_gemini_ensemble") as gemini:
+            response = app.test_client().post('/analyze', data=json.dumps({
+                "baseline": "data:image/jpeg;base64,AAAA",
+                "current": "data:image/jpeg;base64,BBBB",
+            }), content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["notes"], "cached")
+        self.assertTrue(data["analysis_metadata"]["cache_hit"])
+        self.assertEqual(data["analysis_metadata"]["cached_at"], "2020-01-01T00:00:00")
+        self.assertNotEqual(data["analysis_metadata"]["analysis_timestamp"], "2020-01-01T00:00:00")
+        preprocess.assert_not_called()
+        gemini.assert_not_called()
+        cache.setex.assert_not_called()
+
+class TestFetchUrl(unittest.TestCase):
+    def _http(self):
+        resp = mock.MagicMock(status_code=200, headers={"Content-Type": "image/png"})
+        resp.__enter__.return_value = resp
+        resp.raw.read.return_value = b"image-bytes"
+        http = mock.Mock()
+        http.get.return_value = resp
+        return http
+
+    def test_only_cached_fetches_are_reused(self):
+        """Baselines are cached by URL; current images are always re-fetched."""
+        http = self._http()
+        url_cache = index.TTLCache(maxsize=1024, ttl=60, getsizeof=lambda v: len(v[0]))
+        with mock.patch.object(index, "_HTTP", http), mock.patch.object(index, "_URL_CACHE", url_cache):
+            for _ in range(2):
+                self.assertEqual(index._fetch_url("https://cdn/current.png"), (b"image-bytes", "image/png"))
+            self.assertEqual(http.get.call_count, 2)
+            for _ in range(2):
+                index._fetch_url("https://cdn/baseline.png", cache=True)
+            self.assertEqual(http.get.call_count, 3)
+
+class TestAnalyzeCacheWrite(unittest.TestCase):
+    def _post(self, gemini):
+        cache = mock.Mock()
+        cache.get.return_value = None
+        with mock.patch.object(index, "_CACHE", cache), \
+                mock.patch.object(index, "_GENAI_READY", True), \
+                mock.patch.object(index, "AgentOrchestrator", None), \
+                mock.patch.object(index, "_preprocess_with_cv", side_effect=lambda b, c: (b, c)), \
+                mock.patch.object(index, "call_gemini_ensemble", gemini):
+            response = app.test_client().post('/analyze', data=json.dumps({
+                "baseline": "data:image/jpeg;base64,AAAA",
+                "current": "data:image/jpeg;base64,BBBB",
+            }), content_type='application/json')
+        return response, cache
+
+    def test_failed_analysis_is_not_cached(self):
+        """A Gemini failure scores like a clean pass, so it must never reach Redis."""
+        for gemini in (mock.Mock(side_effect=RuntimeError("quota")), mock.Mock(return_value=None)):
+            response, cache = self._post(gemini)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data["analysis_metadata"]["gemini_failed"])
+            cache.setex.assert_not_called()
+
+    def test_successful_analysis_is_cached(self):
+        response, cache = self._post(mock.Mock(return_value=[]))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(json.loads(response.data)["analysis_metadata"]["gemini_failed"])
+        cache.setex.assert_called_once()
+
+class TestNormalizeDiffItem(unittest.TestCase):
+    def test_severity_is_uppercase(self):
+        """Severity is canonicalized once so scoring can compare it directly."""
+        for raw, expected in (("high", "HIGH"), ("Medium", "MEDIUM"), ("LOW", "LOW"), (None, "LOW")):
+            item = _normalize_diff_item({"id": "d1", "severity": raw})
+            self.assertEqual(item["severity"], expected)
+
+    def test_falsy_values_are_kept(self):
+        """Only missing/None fields take defaults."""
+        item = _normalize_diff_item({"id": "d1", "confidence": 0.0, "tis_delta": 0, "description": ""})
+        self.assertEqual(item["confidence"], 0.0)
+        self.assertEqual(item["tis_delta"], 0)
+        self.assertEqual(item["description"], "")
+        self.assertEqual(_normalize_diff_item({"id": "d1", "confidence": None})["confidence"], 0.5)
+
+    def test_explainability_is_wrapped_not_split(self):
+        for raw, expected in (("Corner crushed", ["Corner crushed"]), (("a", "b"), ["a", "b"]),
+                              (["a"], ["a"]), (3, ["3"])):
+            self.assertEqual(_normalize_diff_item({"id": "d1", "explainability": raw})["explainability"], expected)
+
+class TestIsCanonical(unittest.TestCase):
+    def _item(self, **overrides):
+        item = {"id": "d1", "region": "left side", "type": "dent", "description": "",
+                "severity": "LOW", "confidence": 0.5, "explainability": [],
+                "suggested_action": "Review", "tis_delta": -5, "bbox": [0.1, 0.1, 0.2, 0.2]}
+        item.update(overrides)
+        return {"differences": [item]}
+
+    def test_well_formed_payload_is_canonical(self):
+        self.assertTrue(ai._is_canonical(self._item()))
+        self.assertTrue(ai._is_canonical(self._item(bbox=None)))
+
+    def test_wrong_types_go_to_the_validator(self):
+        """Values the schema would reject must not skip validation."""
+        for overrides in ({"tis_delta": "-5"}, {"tis_delta": True},
+                          {"explainability": "Corner crushed"},
+                          {"bbox": [0.1, 0.2]}, {"bbox": "top"},
+                          {"confidence": 1.5}):
+            self.assertFalse(ai._is_canonical(self._item(**overrides)), overrides)
+
+class TestSniffMime(unittest.TestCase):
+    def test_magic_bytes(self):
+        for data, expected in ((b'\x89PNG\r\n\x1a\n', 'image/png'),
+                               (b'RIFF\x00\x00\x00\x00WEBPVP8 ', 'image/webp'),
+                               (b'GIF89a\x01\x00', 'image/gif'),
+                               (b'GIF87a\x01\x00', 'image/gif'),
+                               (b'\xff\xd8\xff\xe0', 'image/jpeg'),
+                               (b'', 'image/jpeg')):
+            self.assertEqual(index._sniff_mime(data), expected)
+
+class TestLoadImageBytes(unittest.TestCase):
+    def test_data_uri(self):
+        encoded = base64.b64encode(b'png-bytes').decode()
+        self.assertEqual(index._load_image_bytes(f"data:image/png;base64,{encoded}"), (b'png-bytes', 'image/png'))
+        self.assertEqual(index._load_image_bytes(f"data:;base64,{encoded}"), (b'png-bytes', 'application/octet-stream'))
+
+    def test_malformed_data_uri(self):
+        self.assertEqual(index._load_image_bytes("data:image/png;base64"), (None, None))
+        self.assertEqual(index._load_image_bytes("data:image/png;base64,\u00e9"), (None, None))
+        self.assertEqual(index._load_image_bytes(""), (None, None))
+
+    def test_bare_base64_is_sniffed(self):
+        data = b'GIF89a' + b'\x00' * 300
+        self.assertEqual(index._load_image_bytes(base64.b64encode(data).decode()), (data, 'image/gif'))
+
+class TestExtractJson(unittest.TestCase):
+    def test_bare_fenced_and_embedded_objects(self):
+        expected = {"differences": [{"id": "d1", "note": "a } brace"}]}
+        body = json.dumps(expected)
+        for text in (body, f"```json\n{body}\n```", f"```\n{body}```",
+                     f"Here you go: {body} hope that helps {{", f"  {body}  "):
+            self.assertEqual(ai._parse_json_text(text), expected, text)
+
+    def test_unparseable_text_yields_none(self):
+        for text in ("", "   ", "no json here", "{not json}", "Sorry, I can't"):
+            self.assertIsNone(ai._parse_json_text(text), text)
+
+    def test_second_parse_is_memoized(self):
+        text = '{"differences": [{"id": "memo"}]}'
+        with mock.patch.object(ai, "_PARSE_CACHE", ai.LRUCache(maxsize=4)), \
+                mock.patch.object(ai, "_parse_json_text", wraps=ai._parse_json_text) as parse:
+            first = ai._extract_json(text)
+            self.assertEqual(ai._extract_json(text), first)
+        parse.assert_called_once_with(text)
+
+    def test_parse_failures_are_not_memoized(self):
+        with mock.patch.object(ai, "_PARSE_CACHE", ai.LRUCache(maxsize=4)), \
+                mock.patch.object(ai, "_parse_json_text", wraps=ai._parse_json_text) as parse:
+            self.assertIsNone(ai._extract_json("Sorry, I can't"))
+            self.assertIsNone(ai._extract_json("Sorry, I can't"))
+        self.assertEqual(parse.call_count, 2)
+
+class TestGeminiResultCache(unittest.TestCase):
+    def test_garbled_response_is_not_cached(self):
+        """A response that cannot be parsed must not pin "no differences" for the pair."""
+        item = {"id": "d1", "region": "left side", "type": "dent", "description": "Dent",
+                "severity": "HIGH", "confidence": 0.9, "explainability": ["dent"],
+                "suggested_action": "Quarantine", "tis_delta": -40}
+        model = mock.Mock(model_name="primary")
+        model.generate_content.side_effect = [
+            [mock.Mock(text="Sorry, I can't")],
+            [mock.Mock(text=json.dumps({"differences": [item]}))],
+        ]
+        baseline, current = ai.ImageInput(b"garbled-baseline"), ai.ImageInput(b"garbled-current")
+        with mock.patch.object(ai, "_RESULT_CACHE", ai.LRUCache(maxsize=4)), \
+                mock.patch.object(ai, "_prepare_call", return_value=(model, ["parts"])):
+            self.assertIsNone(ai.call_gemini_ensemble(baseline, current))
+            self.assertEqual(ai.call_gemini_ensemble(baseline, current), [item])
+            self.assertEqual(ai.call_gemini_ensemble(baseline, current), [item])
+        self.assertEqual(model.generate_content.call_count, 2)
+
+class TestReadJsonBody(unittest.TestCase):
+    def _read(self, body):
+        with app.test_request_context('/analyze', method='POST', data=body, content_type='application/json'):
+            return index._read_json_body()
+
+    def test_object_body(self):
+        self.assertEqual(self._read(b'{"baseline": "x"}'), {"baseline": "x"})
+
+    def test_invalid_and_non_object_bodies(self):
+        for body in (b'', b'not json', b'{"baseline":', b'[1, 2]', b'"text"', b'null'):
+            self.assertEqual(self._read(body), {}, body)
+
+class TestCallWithRetry(unittest.TestCase):
+    def _chunk(self, text):
+        return mock.Mock(text=text)
+
+    def test_retries_transient_errors_then_streams(self):
+        """A retryable error is retried; the next attempt's stream is returned."""
+        model = mock.Mock(model_name="primary")
+        model.generate_content.side_effect = [
+            ai.api_exceptions.ServiceUnavailable("busy"),
+            [self._chunk('{"differences": '), self._chunk('[]}')],
+        ]
+        with mock.patch.object(ai.time, "sleep") as sleep:
+            stream = ai._call_with_retry(model, ["parts"], max_retries=1)
+        self.assertEqual(stream.text, '{"differences": []}')
+        self.assertEqual(model.generate_content.call_count, 2)
+        sleep.assert_called_once()
+
+    def test_returns_none_once_retries_run_out(self):
+        model = mock.Mock(model_name="primary")
+        model.generate_content.side_effect = ai.api_exceptions.ResourceExhausted("quota")
+        with mock.patch.object(ai.time, "sleep"), \
+                mock.patch.object(ai, "_model_for_attempt", lambda m, a, r: m):
+            self.assertIsNone(ai._call_with_retry(model, ["parts"], max_retries=2))
+        self.assertEqual(model.generate_content.call_count, 3)
+
 if __name__ == '__main__':
     unittest.main()